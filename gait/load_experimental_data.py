@@ -218,7 +218,7 @@ class LoadData:
         divide and adjust data dimensions to match number of shooting point for each phase
         """
 
-        index = self.c3d_data.get_indices()
+        index = self.c3d_data.indices
         out = []
         for i in range(len(nb_shooting)):
             if len(data.shape) == 3:
@@ -227,6 +227,6 @@ class LoadData:
                 x = data[:, index[i]: index[i + 1] + 1]
             t_init = np.linspace(0, phase_time[i], (index[i + 1] - index[i]) + 1)
             t_node = np.linspace(0, phase_time[i], nb_shooting[i] + 1)
-            f = interp1d(t_init, x, kind="cubic")
+            f = interp1d(t_init, x, kind="cubic", assume_sorted=True)
             out.append(f(t_node))
         return out
@@ -1,5 +1,8 @@
+import gc
+import os
+
 import numpy as np
-from casadi import vertcat, hcat, MX, sum1
+from casadi import vertcat, hcat, horzcat, reshape, mtimes, MX, DM, Sparsity
 from scipy.interpolate import interp1d
 import biorbd_casadi
 from bioptim import (
@@ -24,12 +27,132 @@ from bioptim import (
 )
 
 
-def get_contact_index(pn, tag):
-    force_names = [s.to_string() for s in pn.nlp.model.contactNames()]
-    return [i for i, t in enumerate([s[-1] == tag for s in force_names]) if t]
+def get_contact_names(model) -> tuple:
+    return tuple(s.to_string() for s in model.contactNames())
+
+
+def get_contact_index(model, tag) -> tuple:
+    return tuple(i for i, name in enumerate(get_contact_names(model)) if name[-1] == tag)
+
+
+def get_contact_selector(contact_index: tuple, nb_contacts: int) -> DM:
+    """
+    Build the sparse matrix that sums the contact forces along the X, Y and Z axes
+
+    Parameters
+    ----------
+    contact_index: tuple
+        The indices of the contact forces along the X, Y and Z axes
+    nb_contacts: int
+        The number of contact forces of the model
+
+    Returns
+    -------
+    The (3 x nb_contacts) selector matrix
+    """
+    rows = [axis for (axis, idx) in enumerate(contact_index) for _ in idx]
+    cols = [i for idx in contact_index for i in idx]
+    return DM(Sparsity.triplet(3, nb_contacts, rows, cols), 1)
+
+
+# --- track markers ---
+def get_markers(pn: PenaltyNode, markers_index: tuple, markers_weight: tuple) -> MX:
+    """
+    Compute the model markers once and scale each group by the square root of its weight,
+    so that a single quadratic objective matches the sum of the weighted groups.
+
+    Parameters
+    ----------
+    pn: PenaltyNode
+        The penalty node elements
+    markers_index: tuple
+        The indices of the markers of each group
+    markers_weight: tuple
+        The weight of each group of markers
+
+    Returns
+    -------
+    The weighted markers position in the MX format.
+    """
+    markers = horzcat(*[m.to_mx() for m in pn.nlp.model.markers(pn.nlp.states["q"].mx)])
+    return vertcat(
+        *[np.sqrt(markers_weight[i]) * reshape(markers[:, m_idx], -1, 1) for (i, m_idx) in enumerate(markers_index)]
+    )
+
+
+def get_markers_target(markers_ref: np.ndarray, markers_index: tuple, markers_weight: tuple) -> np.ndarray:
+    """
+    Reshape and scale the reference markers trajectories to match the output of get_markers
+
+    Parameters
+    ----------
+    markers_ref: np.ndarray
+        The reference markers trajectories (3 x nb_markers x nb_nodes)
+    markers_index: tuple
+        The indices of the markers of each group
+    markers_weight: tuple
+        The weight of each group of markers
+
+    Returns
+    -------
+    The weighted markers target (3 * nb_markers x nb_nodes)
+    """
+    return np.vstack(
+        [
+            np.sqrt(markers_weight[i]) * markers_ref[:, m_idx, :].reshape(3 * len(m_idx), -1, order="F")
+            for (i, m_idx) in enumerate(markers_index)
+        ]
+    )
+
+
+def track_markers(pn: PenaltyNode, markers_index: tuple, markers_weight: tuple) -> MX:
+    """
+    Adds the objective that the mismatch between the model markers and the
+    reference markers trajectories should be minimized.
+
+    Parameters
+    ----------
+    pn: PenaltyNode
+        The penalty node elements
+    markers_index: tuple
+        The indices of the markers of each group
+    markers_weight: tuple
+        The weight of each group of markers
+
+    Returns
+    -------
+    The cost that should be minimize in the MX format.
+    """
+    markers = get_markers(pn, markers_index, markers_weight)
+    return BiorbdInterface.mx_to_cx("markers", markers, pn.nlp.states["q"])
+
 
 # --- track grf ---
-def track_sum_contact_forces(pn: PenaltyNode) -> MX:
+def get_sum_contact_forces(pn: PenaltyNode, contact_index: tuple, states: MX, controls: MX) -> MX:
+    """
+    Compute the sum of the contact forces along the X, Y and Z axes
+
+    Parameters
+    ----------
+    pn: PenaltyNode
+        The penalty node elements
+    contact_index: tuple
+        The indices of the contact forces along the X, Y and Z axes
+    states: MX
+        The symbolic states
+    controls: MX
+        The symbolic controls
+
+    Returns
+    -------
+    The sum of the contact forces in the MX format.
+    """
+    force_tp = pn.nlp.contact_forces_func(states, controls, pn.nlp.parameters.mx)
+
+    return mtimes(get_contact_selector(contact_index, force_tp.shape[0]), force_tp)
+
+
+def track_sum_contact_forces(pn: PenaltyNode, contact_index: tuple) -> MX:
     """
     Adds the objective that the mismatch between the
     sum of the contact forces and the reference ground reaction forces should be minimized.
@@ -38,19 +161,18 @@ def track_sum_contact_forces(pn: PenaltyNode) -> MX:
     ----------
     pn: PenaltyNode
         The penalty node elements
+    contact_index: tuple
+        The indices of the contact forces along the X, Y and Z axes
 
     Returns
     -------
     The cost that should be minimize in the MX format.
     """
-    states = vertcat(pn.nlp.states["q"].mx, pn.nlp.states["qdot"].mx)
-    controls = vertcat(pn.nlp.controls["tau"].mx, pn.nlp.controls["muscles"].mx)
-    force_tp = pn.nlp.contact_forces_func(states, controls, pn.nlp.parameters.mx)
-
-    force = vertcat(sum1(force_tp[get_contact_index(pn, "X"), :]),
-                    sum1(force_tp[get_contact_index(pn, "Y"), :]),
-                    sum1(force_tp[get_contact_index(pn, "Z"), :]))
-    return BiorbdInterface.mx_to_cx("grf", force, pn.nlp.states["q"], pn.nlp.states["qdot"], pn.nlp.controls["tau"], pn.nlp.controls["muscles"])
+    # states.mx and controls.mx build a new concatenation at each access, read them once
+    states, controls = pn.nlp.states.mx, pn.nlp.controls.mx
+    force = get_sum_contact_forces(pn, contact_index, states, controls)
+    func = biorbd_casadi.to_casadi_func("grf", force, states, controls)
+    return func(pn.nlp.states.cx, pn.nlp.controls.cx)
 
 
 def prepare_ocp(
@@ -62,6 +184,8 @@ def prepare_ocp(
     q_ref: list,
     qdot_ref: list,
     activation_ref : list,
+    x_init_ref: list,
+    u_init_ref: list,
     nb_threads: int,
     ode_solver=OdeSolver.RK4(),
 ) -> OptimalControlProgram:
@@ -89,6 +213,10 @@ def prepare_ocp(
         List of the array of joint velocities.
         Those velocities were computed using Kalman filter
         They are used as initial guess
+    x_init_ref: list
+        List of the array of states used as initial guess (1 array for each phase)
+    u_init_ref: list
+        List of the array of controls used as initial guess (1 array for each phase)
     nb_threads:int
         The number of threads used
 
@@ -116,15 +244,29 @@ def prepare_ocp(
     markers_foot = [19, 20, 21, 22, 23, 24, 25] # ["R_FCC", "R_FM1", "R_FMP1", "R_FM2", "R_FMP2", "R_FM5", "R_FMP5"]
     markers_index = (markers_pelvis, markers_anat, markers_foot, markers_tissus)
     weight = (10000, 1000, 10000, 100)
+    grf_weight = 0.01
     objective_functions = ObjectiveList()
     for p in range(nb_phases):
-        for (i, m_idx) in enumerate(markers_index):
+        objective_functions.add(
+            track_markers,  # track all the markers groups at once
+            custom_type=ObjectiveFcn.Lagrange,
+            markers_index=markers_index,
+            markers_weight=weight,
+            target=get_markers_target(markers_ref[p], markers_index, weight),
+            node=Node.ALL,
+            weight=1,
+            quadratic=True,
+            phase=p,
+        )
+        if p < nb_phases - 1:
+            # --- track contact forces for the stance phase ---
             objective_functions.add(
-                ObjectiveFcn.Lagrange.TRACK_MARKERS,
+                track_sum_contact_forces,
+                custom_type=ObjectiveFcn.Lagrange,
+                contact_index=tuple(get_contact_index(biorbd_model[p], tag) for tag in ("X", "Y", "Z")),
+                target=grf_ref[p],
                 node=Node.ALL,
-                weight=weight[i],
-                marker_index=m_idx,
-                target=markers_ref[p][:, m_idx, :],
+                weight=grf_weight,
                 quadratic=True,
                 phase=p,
             )
@@ -135,26 +277,15 @@ def prepare_ocp(
         objective_functions.add(ObjectiveFcn.Lagrange.MINIMIZE_CONTROL, key="muscles", weight=10, phase=p, quadratic=True,)
         objective_functions.add(ObjectiveFcn.Lagrange.MINIMIZE_CONTROL, key="tau", derivative=True, weight=0.1, quadratic=True, phase=p)
 
-    # --- track contact forces for the stance phase ---
-    for p in range(nb_phases - 1):
-        objective_functions.add(
-            track_sum_contact_forces,  # track contact forces
-            custom_type=ObjectiveFcn.Lagrange,
-            target=grf_ref[p],
-            node=Node.ALL,
-            weight=0.01,
-            quadratic=True,
-            phase=p,
-        )
-
     # Dynamics
     dynamics = DynamicsList()
     for p in range(nb_phases - 1):
-        dynamics.add(DynamicsFcn.MUSCLE_DRIVEN, phase=p, with_contact=True, with_torque=True, expand=False)
-    dynamics.add(DynamicsFcn.MUSCLE_DRIVEN, phase=3, with_torque=True, expand=False)
+        dynamics.add(DynamicsFcn.MUSCLE_DRIVEN, phase=p, with_contact=True, with_torque=True, expand=True)
+    dynamics.add(DynamicsFcn.MUSCLE_DRIVEN, phase=3, with_torque=True, expand=True)
 
     # Constraints
     m_heel, m_m1, m_m5, m_toes = 26, 27, 28, 29
+    contact_heel = [i for i, name in enumerate(get_contact_names(biorbd_model[1])) if "Heel_r" in name]
     constraints = ConstraintList()
     # null speed for the first phase --> non sliding contact point
     constraints.add(ConstraintFcn.TRACK_MARKERS_VELOCITY, node=Node.START, marker_index=m_heel, phase=0)
@@ -184,7 +315,7 @@ def prepare_ocp(
     constraints.add(  # forces heel at zeros at the end of the phase
         ConstraintFcn.TRACK_CONTACT_FORCES,
         node=Node.PENULTIMATE,
-        contact_index=[i for i, name in enumerate(biorbd_model[1].contactNames()) if "Heel_r" in name.to_string()],
+        contact_index=contact_heel,
         phase=1,
     )
 
@@ -225,20 +356,18 @@ def prepare_ocp(
     # Initial guess
     x_init = InitialGuessList()
     u_init = InitialGuessList()
-
-    ocp_previous, sol_previous = OptimalControlProgram.load("gait.bo")
     for p in range(nb_phases):
         # init_x = np.zeros((nb_q + nb_qdot, nb_shooting[p] + 1))
         # init_x[:nb_q, :] = q_ref[p]
         # init_x[nb_q : nb_q + nb_qdot, :] = qdot_ref[p]
         # x_init.add(init_x, interpolation=InterpolationType.EACH_FRAME)
 
-        x_init.add(sol_previous.states[p]['all'], interpolation=InterpolationType.EACH_FRAME)
+        x_init.add(x_init_ref[p], interpolation=InterpolationType.EACH_FRAME)
 
         # init_u = np.zeros((nb_tau + nb_mus, nb_shooting[p]))
         # init_u[nb_tau:, :] = activation_ref[p][:, :-1]
         # u_init.add(init_u, interpolation=InterpolationType.EACH_FRAME)
-        u_init.add(sol_previous.controls[p]['all'][:, :-1], interpolation=InterpolationType.EACH_FRAME)
+        u_init.add(u_init_ref[p], interpolation=InterpolationType.EACH_FRAME)
 
     # ------------- #
     return OptimalControlProgram(
@@ -258,11 +387,49 @@ def prepare_ocp(
     )
 
 
+def load_warm_start(warm_start_file: str) -> tuple:
+    """
+    Load the states and controls of a previous solution to use them as initial guess.
+    The arrays are cached next to the .bo file in a .npz file so that the next runs do not have to
+    unpickle the whole previous ocp. The cache is rebuilt when the .bo file is newer.
+
+    Parameters
+    ----------
+    warm_start_file: str
+        The path to the previous solution (.bo)
+
+    Returns
+    -------
+    The list of the states and the list of the controls (1 array for each phase)
+    """
+    cache_file = os.path.splitext(warm_start_file)[0] + "_init.npz"
+    if os.path.isfile(cache_file) and (
+        not os.path.isfile(warm_start_file) or os.path.getmtime(warm_start_file) <= os.path.getmtime(cache_file)
+    ):
+        with np.load(cache_file) as data:
+            nb_phases = int(data["nb_phases"])
+            x_init_ref = [data[f"x_{p}"] for p in range(nb_phases)]
+            u_init_ref = [data[f"u_{p}"] for p in range(nb_phases)]
+    else:
+        ocp_previous, sol_previous = OptimalControlProgram.load(warm_start_file)
+        nb_phases = len(sol_previous.states)
+        x_init_ref = [sol_previous.states[p]["all"] for p in range(nb_phases)]
+        u_init_ref = [sol_previous.controls[p]["all"][:, :-1] for p in range(nb_phases)]
+        # only the arrays are needed, free the previous ocp graphs right away
+        del ocp_previous, sol_previous
+        gc.collect()
+        np.savez_compressed(
+            cache_file,
+            nb_phases=nb_phases,
+            **{f"x_{p}": x_init_ref[p] for p in range(nb_phases)},
+            **{f"u_{p}": u_init_ref[p] for p in range(nb_phases)},
+        )
+    return x_init_ref, u_init_ref
+
+
 def get_phase_time_shooting_numbers(data, dt):
     phase_time = data.c3d_data.get_time()
-    number_shooting_points = []
-    for time in phase_time:
-        number_shooting_points.append(int(time / dt))
+    number_shooting_points = (np.asarray(phase_time) / dt).astype(int).tolist()
     return phase_time, number_shooting_points
 
 
@@ -1,16 +1,25 @@
+import os
+
+# avoid oversubscription: casadi handles the parallelism, BLAS/OpenMP run serially
+os.environ.setdefault("OMP_NUM_THREADS", "1")
+os.environ.setdefault("MKL_NUM_THREADS", "1")
+os.environ.setdefault("OPENBLAS_NUM_THREADS", "1")
+os.environ.setdefault("OMP_NESTED", "FALSE")
+
 from time import time
 
 import numpy as np
 import biorbd_casadi as biorbd
-from bioptim import Solver, Shooting, OdeSolver
+from bioptim import Solver, Shooting, OdeSolver, InitialGuessList, InterpolationType
 import matplotlib.pyplot as plt
 
 from gait.load_experimental_data import LoadData
-from gait.ocp import prepare_ocp, get_phase_time_shooting_numbers, get_experimental_data
+from gait.ocp import prepare_ocp, get_phase_time_shooting_numbers, get_experimental_data, load_warm_start
 
 # version biorbd : 1.8.4
 # version bioptim : 2.2.0
 # version bioviz : 2.1.5 
+# Ipopt must be linked against HSL (coinhsl) for the ma57 linear solver, otherwise use "mumps"
 
 if __name__ == "__main__":
     root_path = "/".join(__file__.split("/")[:-1]) + "/"
@@ -29,6 +38,9 @@ if __name__ == "__main__":
     nb_tau = biorbd_model[0].nbGeneralizedTorque()
     nb_phases = len(biorbd_model)
     nb_markers = biorbd_model[0].nbMarkers()
+    nb_threads = 8
+    # compile the nlp to native code: faster iterations, but nlp.c is rebuilt at every run (turn off for development)
+    c_compile = True
 
     # Generate data from file
     # --- files path ---
@@ -41,6 +53,8 @@ if __name__ == "__main__":
     phase_time, number_shooting_points = get_phase_time_shooting_numbers(data, 0.01)
     # --- get experimental data ---
     q_ref, qdot_ref, markers_ref, grf_ref, moments_ref, cop_ref, emg_ref = get_experimental_data(data, number_shooting_points, phase_time)
+    # --- get initial guess from previous solution ---
+    x_init_ref, u_init_ref = load_warm_start("gait.bo")
 
     ocp = prepare_ocp(
         biorbd_model=biorbd_model,
@@ -51,21 +65,44 @@ if __name__ == "__main__":
         q_ref=q_ref,
         qdot_ref=qdot_ref,
         activation_ref=emg_ref,
-        nb_threads=8,
+        x_init_ref=x_init_ref,
+        u_init_ref=u_init_ref,
+        nb_threads=nb_threads,
         ode_solver=OdeSolver.RK4(),
     )
 
     tic = time()
     # --- Solve the program --- #
     solver = Solver.IPOPT()
-    solver.set_linear_solver("mumps")
+    solver.set_linear_solver("ma57")
     solver.set_convergence_tolerance(1e-3)
-    solver.set_hessian_approximation("exact")
+    solver.set_hessian_approximation("limited-memory")
+    solver.set_limited_memory_max_history(15)
     solver.set_maximum_iterations(3000)
+    solver.set_c_compile(c_compile)
+    solver.set_print_level(3)
     solver.show_online_optim=False
     sol = ocp.solve(solver=solver)
     toc = time() - tic
 
+    if sol.status != 0:
+        # fallback to the exact hessian, starting from the last quasi-newton iterate
+        x_init = InitialGuessList()
+        u_init = InitialGuessList()
+        for p in range(nb_phases):
+            x_init.add(sol.states[p]["all"], interpolation=InterpolationType.EACH_FRAME)
+            u_init.add(sol.controls[p]["all"][:, :-1], interpolation=InterpolationType.EACH_FRAME)
+        ocp.update_initial_guess(x_init, u_init)
+        solver.set_hessian_approximation("exact")
+        # force bioptim to rebuild the (compiled) nlpsol with the new hessian option
+        ocp.program_changed = True
+        tic = time()
+        sol = ocp.solve(solver=solver)
+        toc_exact = time() - tic
+        print(f"Time to solve with the limited-memory hessian : {toc}s, with the exact hessian : {toc_exact}s")
+    else:
+        print(f"Time to solve : {toc}s")
+
     # --- Save results --- #
     ocp.save(sol, "gait_test.bo")
 